@@ -1,13 +1,54 @@
 """Collects node inventory and posts to Redis."""
 
+import argparse
+import collections
 import concurrent.futures
+import contextlib
+import functools
+import glob
+import itertools
 import logging
+import math
+import os
 import platform
+import re
+import shutil
+import struct
 import subprocess
+import sys
 import time
+from multiprocessing import shared_memory
 
+import orjson
 import redis
 
+# subprocess only uses posix_spawn instead of fork when the executable is given
+# as a path and close_fds is off. Python opens descriptors non-inheritable, so
+# leaving close_fds off does not leak them to smartctl.
+SMARTCTL = shutil.which("smartctl") or "smartctl"
+
+# Property lines in a udev database entry, matched over the whole file
+UDEV_PROPERTY = re.compile(rb"^E:([^=\n]+)=(.*)$", re.MULTILINE)
+
+CACHE_PATH = "/run/node_inventory.cache.json"
+
+# Local consumers attach to this segment by name. The header holds a
+# generation number, bumped whenever the disk layout changes, and the number of
+# slots in use. Each slot holds the disk name, null padded to 8 bytes, and the
+# temperature in millidegrees Celsius. The segment is sized once for
+# SHM_MAX_SLOTS so it never has to be recreated under attached readers.
+SHM_NAME = "node_inv_temps"
+SHM_HEADER = struct.Struct("<II8x")
+SHM_NAME_LEN = 8
+SHM_SLOT = struct.Struct(f"<{SHM_NAME_LEN}si4x")
+SHM_MAX_SLOTS = 64
+SHM_TEMP_UNKNOWN = -(2**31)
+
+POLL_INTERVAL = 5
+TEMP_EXPIRY = 2 * POLL_INTERVAL
+MAX_BACKOFF = 60
+REDIS_TIMEOUT = 1.5
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -19,10 +60,44 @@ formatter = logging.Formatter("%(levelname)s: %(message)s")
 console_log.setFormatter(formatter)
 logger.addHandler(console_log)
 
+# Connections are made lazily and re-established by the client on the next
+# command after a failure. The timeouts keep a hung or unreachable server from
+# stalling the poll loop, they must stay well under POLL_INTERVAL.
+redis_conn = redis.Redis(
+    host="192.168.10.6",
+    port=6379,
+    db=0,
+    socket_connect_timeout=REDIS_TIMEOUT,
+    socket_timeout=REDIS_TIMEOUT,
+)
+
+
+def read_sys_file(path):
+    """Reads the first line of a sysfs or procfs file and returns it
+    stripped.
+    """
+    with open(path, "r", encoding="utf-8") as sys_file:
+        return sys_file.readline().strip()
+
+
+def format_size(size):
+    """Formats a size in bytes the same way lsblk and lsmem do, using binary
+    units and a single decimal place.
+    """
+    for unit in ("B", "K", "M", "G", "T"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "P"
+
+    return f"{size:.1f}".rstrip("0").rstrip(".") + unit
+
 
+@functools.cache
 def get_model_info():
     """Collects the node model and serial number from system files and returns
-    the map.
+    the map. The result is cached for the life of the process.
     """
     model_info = {}
 
@@ -35,214 +110,760 @@ def get_model_info():
     return model_info
 
 
+@functools.cache
 def get_cpu_info():
-    """Reads the output of lscpu and parses thread, core, socket and model info
-    and returns the map.
+    """Reads the CPU topology from sysfs and the model from the first
+    processor entry of /proc/cpuinfo and returns the map. CPU topology does
+    not change while the process runs so the result is cached.
     """
     cpu_info = []
 
-    results = (
-        subprocess.run(
-            ["lscpu"],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        .stdout.strip()
-        .split("\n")
-    )
+    # Every processor entry repeats the same model, so only the first entry
+    # is read
+    with open("/proc/cpuinfo", "r", encoding="utf-8") as cpuinfo:
+        fields = {
+            key.strip(): value.strip()
+            for key, value in (
+                line.split(":", 1)
+                for line in itertools.takewhile(str.strip, cpuinfo)
+                if ":" in line
+            )
+        }
+
+    model = fields.get("model name", fields.get("Model"))
+
+    # Group the online CPUs into cores by their hyperthread sibling mask, per
+    # package. Hybrid parts mix single and dual thread cores, so threads is
+    # the widest core, matching what lscpu reports.
+    packages = collections.defaultdict(set)
+
+    for topology in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/topology"):
+        package = int(read_sys_file(f"{topology}/physical_package_id"))
+        packages[package].add(read_sys_file(f"{topology}/thread_siblings"))
+
+    for i, package in enumerate(sorted(packages)):
+        cores = packages[package]
+        threads = max(int(mask.replace(",", ""), 16).bit_count() for mask in cores)
 
-    for line in results:
-        if line.startswith("Thread"):
-            threads = line.split(":")[1].strip()
-        elif line.startswith("Core"):
-            cores = line.split(":")[1].strip()
-        elif line.startswith("Socket"):
-            sockets = line.split(":")[1].strip()
-        elif line.startswith("Model name"):
-            model = line.split(":")[1].strip()
-
-    for i in range(0, int(sockets)):
         cpu_info.append(
             {
                 "cpu_num": f"{i}",
                 "model": model,
-                "cores": cores,
-                "threads": threads,
+                "cores": f"{len(cores)}",
+                "threads": f"{threads}",
             }
         )
 
     return cpu_info
 
 
+@functools.cache
 def get_mem_info():
-    """Parses online memory from the lsmem command and returns the map."""
-    results = (
-        subprocess.run(["lsmem"], capture_output=True, text=True, check=True)
-        .stdout.strip()
-        .split("\n")
-    )
+    """Sums the online memory blocks from sysfs and returns the map. The
+    result is cached for the life of the process.
+    """
+    mem_path = "/sys/devices/system/memory"
+
+    with open(f"{mem_path}/block_size_bytes", "r", encoding="utf-8") as block_size:
+        block_bytes = int(block_size.readline().strip(), 16)
 
-    for line in results:
-        if line.startswith("Total online"):
-            mem = line.split(":")[1].strip()
+    online_blocks = 0
+
+    for block in glob.glob(f"{mem_path}/memory*/online"):
+        with open(block, "r", encoding="utf-8") as online:
+            if online.readline().strip() == "1":
+                online_blocks += 1
 
     mem_info = {
-        "memory": mem,
+        "memory": format_size(online_blocks * block_bytes),
     }
 
     return mem_info
 
 
-def get_disk_serial(disk):
-    """Runs smartctl with the disk specified, parses the serial number of the
-    disk and returns a tuple of the disk and the serial number.
+def get_udev_properties(dev_num):
+    """Reads the udev database entry for a block device, the same source lsblk
+    uses for its SERIAL, WWN and TRAN columns, and returns the properties as a
+    map. Returns an empty map when udev has no entry for the device.
     """
-    serial = None
-
-    results = subprocess.run(
-        ["smartctl", "-i", f"/dev/{disk}"],
-        capture_output=True,
-        text=True,
-        check=True,
-    ).stdout.split("\n")
-
-    for line in results:
-        if line.startswith("Serial"):
-            serial = line.split(":")[1].strip()
+    try:
+        with open(f"/run/udev/data/b{dev_num}", "rb") as udev_data:
+            contents = udev_data.read()
+    except FileNotFoundError:
+        return {}
 
-    return disk, serial
+    return {
+        key.decode(): value.decode() for key, value in UDEV_PROPERTY.findall(contents)
+    }
 
 
-def get_disk_info():
-    """Collects the disk information from the host using the lsblk and smartctl
-    commands and returns a map.
+@functools.cache
+def get_smart_devices():
+    """Runs a single smartctl scan and returns a map of each device path to
+    the device type smartctl detected for it. The scan opens every device so
+    it is only run once, disks added later are queried with '-d auto'.
     """
-    disk_info = []
-    disk_list = []
-
-    lsblk_list = (
+    results = orjson.loads(
         subprocess.run(
-            [
-                "lsblk",
-                "--noheadings",
-                "--list",
-                "--nodeps",
-                "--exclude",
-                "7,11",
-                "--output",
-                "KNAME,HCTL,ROTA,SIZE",
-            ],
+            [SMARTCTL, "--scan-open", "--json"],
             capture_output=True,
-            text=True,
             check=True,
-        )
-        .stdout.strip()
-        .split("\n")
+            close_fds=False,
+        ).stdout
     )
 
-    for item in lsblk_list:
-        disk_spec = item.split()
+    return {device["name"]: device["type"] for device in results.get("devices", [])}
 
-        disk = {}
 
-        disk_list.append(disk_spec[0])
+def get_smart_type(disk, smart_devices):
+    """Returns the smartctl device type for the disk from the scan results.
+    NVMe devices are listed by controller so the namespace suffix is dropped.
+    """
+    device = f"/dev/{disk}"
+
+    if disk.startswith("nvme"):
+        device = device.rsplit("n", 1)[0]
+
+    return smart_devices.get(device, "auto")
+
+
+def get_smartctl_args(option, name, smart_type):
+    """Returns the smartctl command line for querying the disk with the given
+    option and smartctl device type.
+    """
+    return [
+        SMARTCTL,
+        "--json",
+        option,
+        "-d",
+        smart_type,
+        f"/dev/{name}",
+    ]
+
+
+def wait_for_command(proc):
+    """Waits for a command started by run_commands and returns its raw output
+    bytes, raising CalledProcessError if it failed.
+    """
+    stdout, stderr = proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, stdout, stderr)
 
-        if disk_spec[0].startswith("nvme"):
-            disk["name"] = disk_spec[0]
-            disk["size"] = disk_spec[2]
-            disk["type"] = "nvme"
+    return stdout
+
+
+def run_commands(commands, max_procs):
+    """Starts up to max_procs commands at once, starting the next as the
+    oldest finishes, so the child processes overlap without a thread per
+    command. Returns the raw output bytes of each command in order.
+    """
+    results = []
+    running = collections.deque()
+
+    with contextlib.ExitStack() as stack:
+        for command in commands:
+            if len(running) >= max_procs:
+                results.append(wait_for_command(running.popleft()))
+
+            running.append(
+                stack.enter_context(
+                    subprocess.Popen(
+                        command,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        close_fds=False,
+                    )
+                )
+            )
+
+        while running:
+            results.append(wait_for_command(running.popleft()))
+
+    return results
+
+
+def get_disk_serials(disks, max_procs):
+    """Runs smartctl on all of the disks specified, parses the serial number
+    of each and returns the serial numbers in the same order as the disks.
+    """
+    if not disks:
+        return []
+
+    smart_devices = get_smart_devices()
+    results = run_commands(
+        [
+            get_smartctl_args(
+                "-i", disk["name"], get_smart_type(disk["name"], smart_devices)
+            )
+            for disk in disks
+        ],
+        max_procs,
+    )
+
+    return [orjson.loads(output).get("serial_number") for output in results]
+
+
+def get_block_devices():
+    """Returns a map of each block device name to its major:minor number,
+    skipping loop (7) and cdrom (11) devices the same as lsblk --exclude 7,11.
+    Hidden devices, such as the per-path nvmeXcYnZ disks behind an NVMe
+    multipath head, are skipped as lsblk does.
+    """
+    block_devices = {}
+
+    for sys_path in sorted(glob.glob("/sys/block/*")):
+        hidden_path = f"{sys_path}/hidden"
+        if os.path.isfile(hidden_path) and read_sys_file(hidden_path) == "1":
+            continue
+
+        dev_num = read_sys_file(f"{sys_path}/dev")
+        if dev_num.split(":")[0] not in ("7", "11"):
+            block_devices[os.path.basename(sys_path)] = dev_num
+
+    return block_devices
+
+
+def get_disk(sys_path, dev_num):
+    """Builds the map for one block device from sysfs and the udev database.
+    The serial is left out when neither source exposes it.
+    """
+    name = os.path.basename(sys_path)
+    udev_props = get_udev_properties(dev_num)
+
+    disk = {}
+    disk["name"] = name
+    disk["size"] = format_size(int(read_sys_file(f"{sys_path}/size")) * 512)
+
+    if "ID_WWN" in udev_props:
+        disk["wwn"] = udev_props["ID_WWN"]
+
+    # NVMe namespaces have no HCTL, dispatch on the transport the kernel
+    # reports rather than on the device name. With native multipath the
+    # namespace head sits under the nvme-subsystem class instead of nvme.
+    real_path = os.path.realpath(sys_path)
+    if "/nvme/" in real_path or "/nvme-subsystem/" in real_path:
+        disk["type"] = "nvme"
+    else:
+        if os.path.isdir(f"{sys_path}/device/scsi_device"):
+            disk["path"] = os.listdir(f"{sys_path}/device/scsi_device")[0]
+        if read_sys_file(f"{sys_path}/queue/rotational") == "1":
+            disk["type"] = "hdd"
         else:
-            disk["name"] = disk_spec[0]
-            disk["path"] = disk_spec[1]
-            disk["size"] = disk_spec[3]
-            disk["type"] = "nvme"
-            if disk_spec[2] == "1":
-                disk["type"] = "hdd"
-            else:
-                disk["type"] = "ssd"
+            disk["type"] = "ssd"
 
-        disk_info.append(disk)
+    if os.path.isfile(f"{sys_path}/device/serial"):
+        disk["serial"] = read_sys_file(f"{sys_path}/device/serial")
+    elif "ID_SERIAL_SHORT" in udev_props:
+        disk["serial"] = udev_props["ID_SERIAL_SHORT"]
+
+    return disk
+
+
+def get_disk_info(max_procs):
+    """Collects the disk information from the host using sysfs and the udev
+    database, falling back to smartctl for serial numbers neither exposes, and
+    returns a map. smartctl is only run when some disk needs it.
+    """
+    disk_info = []
+    missing_serial = []
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        disk_serials = executor.map(get_disk_serial, disk_list)
+    for name, dev_num in get_block_devices().items():
+        disk = get_disk(f"/sys/block/{name}", dev_num)
 
-    for serial in disk_serials:
-        for disk in disk_info:
-            if serial[0] == disk["name"]:
-                disk["serial"] = serial[1]
+        if "serial" not in disk:
+            missing_serial.append(disk)
+
+        disk_info.append(disk)
+
+    # Only disks whose serial neither sysfs nor udev knows are sent to
+    # smartctl, the results are written straight into their maps
+    serials = get_disk_serials(missing_serial, max_procs)
+    for disk, serial in zip(missing_serial, serials):
+        disk["serial"] = serial
 
     return disk_info
 
 
-def get_disk_temps(disk: dict):
-    """Runs the smartctl command on the disk and parses the temperature from
-    the output. Returns a formatted string.
+def find_temp_path(name):
+    """Returns the hwmon temperature file for the disk, exposed by the nvme
+    driver for NVMe and by the drivetemp module for SATA, or None when the disk
+    has no hwmon sensor. NVMe multipath heads point at the subsystem, so the
+    sensor is found through one of its controllers.
     """
-    temp = None
+    sys_path = f"/sys/block/{name}/device"
+    temp_paths = sorted(
+        glob.glob(f"{sys_path}/hwmon*/temp1_input")
+        + glob.glob(f"{sys_path}/hwmon/hwmon*/temp1_input")
+        + glob.glob(f"{sys_path}/nvme*/hwmon*/temp1_input")
+    )
 
-    results = subprocess.run(
-        ["smartctl", "-A", f"/dev/{disk['name']}"],
-        capture_output=True,
-        text=True,
-        check=True,
-    ).stdout.split("\n")
+    return temp_paths[0] if temp_paths else None
 
-    if disk["name"].startswith("nvme"):
-        for line in results:
-            if line.startswith("Temperature:"):
-                temp = line.split()[1].strip()
-    else:
-        for line in results:
-            if line.startswith("194 Temperature"):
-                temp = line.split()[9].strip()
 
-    return f"{disk['name']} {temp}"
+def get_temp_sources(disks):
+    """Resolves and opens the hwmon temperature file for each disk and returns
+    a list of tuples of the disk name, the open file descriptor and the
+    smartctl device type. Disks without a hwmon sensor have no descriptor and
+    are read through smartctl instead, only they need the smartctl scan.
+    """
+    temp_sources = []
 
+    for disk in disks:
+        name = disk["name"]
+        temp_path = find_temp_path(name)
 
-def main():
-    """Connects to the Redis server and sets info based on the information
-    collected from the node.
+        if temp_path is None:
+            temp_sources.append((name, None, get_smart_type(name, get_smart_devices())))
+        else:
+            temp_sources.append((name, os.open(temp_path, os.O_RDONLY), None))
+
+    return temp_sources
+
+
+def close_temp_sources(temp_sources):
+    """Closes the file descriptors opened by get_temp_sources."""
+    for _, temp_fd, _ in temp_sources:
+        if temp_fd is not None:
+            os.close(temp_fd)
+
+
+def get_disk_temps(temp_sources, pool, max_procs):
+    """Reads the temperature of each disk from its already open hwmon file, or
+    from the smartctl JSON output for disks without one. smartctl runs on the
+    pool while the hwmon files are read. Returns a list of tuples of the disk
+    name and the temperature in millidegrees Celsius.
+    """
+    temps = {}
+
+    smart_sources = [
+        (name, smart_type)
+        for name, temp_fd, smart_type in temp_sources
+        if temp_fd is None
+    ]
+    smart_future = pool.submit(
+        run_commands,
+        [
+            get_smartctl_args("-A", name, smart_type)
+            for name, smart_type in smart_sources
+        ],
+        max_procs,
+    )
+
+    for name, temp_fd, _ in temp_sources:
+        if temp_fd is None:
+            continue
+
+        # Reading from offset 0 makes sysfs regenerate the value, hwmon
+        # already reports millidegrees Celsius. A sleeping, failing or removed
+        # disk fails the read, which only loses that disk's sample.
+        try:
+            temps[name] = int(os.pread(temp_fd, 32, 0))
+        except (OSError, ValueError) as err:
+            logger.warning("Unable to read temperature of %s: %s", name, err)
+            temps[name] = None
+
+    for (name, _), output in zip(smart_sources, smart_future.result()):
+        temp = orjson.loads(output).get("temperature", {}).get("current")
+        temps[name] = None if temp is None else temp * 1000
+
+    return [(name, temps[name]) for name, _, _ in temp_sources]
+
+
+class TempSharedMemory:
+    """Shared memory segment the temperature samples are written to for local
+    consumers, see SHM_NAME for the layout.
+    """
+
+    def __init__(self):
+        size = SHM_HEADER.size + SHM_MAX_SLOTS * SHM_SLOT.size
+
+        try:
+            self.shm = shared_memory.SharedMemory(
+                name=SHM_NAME, create=True, size=size
+            )
+        except FileExistsError:
+            # Left behind by an earlier run that did not shut down cleanly
+            stale = shared_memory.SharedMemory(name=SHM_NAME)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(
+                name=SHM_NAME, create=True, size=size
+            )
+
+        self.generation = 0
+        self.slots = []
+
+    def layout(self, names):
+        """Assigns a slot to each disk name and bumps the generation. Names
+        that do not fit the slot, or disks beyond SHM_MAX_SLOTS, are logged
+        and left without a slot.
+        """
+        self.slots = []
+        used = 0
+
+        for name in names:
+            encoded = name.encode()
+
+            if len(encoded) > SHM_NAME_LEN or used == SHM_MAX_SLOTS:
+                logger.warning("Disk %s left out of shared memory segment.", name)
+                self.slots.append(None)
+                continue
+
+            offset = SHM_HEADER.size + used * SHM_SLOT.size
+            SHM_SLOT.pack_into(self.shm.buf, offset, encoded, SHM_TEMP_UNKNOWN)
+            self.slots.append(offset)
+            used += 1
+
+        # Clear slots left over from a larger layout
+        for index in range(used, SHM_MAX_SLOTS):
+            offset = SHM_HEADER.size + index * SHM_SLOT.size
+            SHM_SLOT.pack_into(self.shm.buf, offset, b"", SHM_TEMP_UNKNOWN)
+
+        self.generation += 1
+        SHM_HEADER.pack_into(self.shm.buf, 0, self.generation, used)
+
+    def write(self, temp_list):
+        """Writes the temperature samples, in layout order, into their slots."""
+        for offset, (_, temp) in zip(self.slots, temp_list):
+            if offset is not None:
+                struct.pack_into(
+                    "<i",
+                    self.shm.buf,
+                    offset + SHM_NAME_LEN,
+                    SHM_TEMP_UNKNOWN if temp is None else temp,
+                )
+
+    def close(self):
+        """Closes and removes the shared memory segment."""
+        self.shm.close()
+        self.shm.unlink()
+
+
+def write_temps(temp_list):
+    """Writes the temperature samples to stdout as a single '|' separated
+    line, streaming each sample into the buffered writer instead of joining
+    them into a new string first.
+    """
+    out = sys.stdout.buffer
+
+    for index, (name, temp) in enumerate(temp_list):
+        if index:
+            out.write(b"|")
+        out.write(f"{name} {None if temp is None else temp // 1000}".encode())
+
+    out.write(b"\n")
+    out.flush()
+
+
+def publish_host_info(host_info):
+    """Writes the inventory to a hash named after the host. Nested values are
+    stored as JSON and any key left by an older version is replaced.
+    """
+    host_key = host_info["host"]
+
+    with redis_conn.pipeline() as pipe:
+        pipe.delete(host_key)
+        pipe.hset(
+            host_key,
+            mapping={
+                key: orjson.dumps(value) if isinstance(value, list) else value
+                for key, value in host_info.items()
+            },
+        )
+        pipe.execute()
+
+
+def publish_temps(host_key, temp_list):
+    """Queues every temperature sample, in degrees Celsius, and sends them in
+    one round trip. The samples expire so a stopped node does not leave stale
+    readings behind.
+    """
+    with redis_conn.pipeline(transaction=False) as pipe:
+        for name, temp in temp_list:
+            if temp is not None:
+                pipe.set(f"{host_key}:temp:{name}", temp // 1000, ex=TEMP_EXPIRY)
+        pipe.execute()
+
+
+class RedisPublisher:
+    """Publishes the inventory and temperature samples without ever blocking
+    the poll loop. After a connection error publishing is skipped until an
+    exponentially growing backoff has passed, and the inventory is written
+    again once the server answers, in case it lost its data.
+    """
+
+    def __init__(self):
+        self.connected = False
+        self.backoff = 0
+        self.retry_at = 0.0
+        self.host_info_pending = True
+
+    def republish_host_info(self):
+        """Marks the inventory to be written again on the next publish."""
+        self.host_info_pending = True
+
+    def publish(self, host_info, temp_list=()):
+        """Publishes the inventory if it is pending and the temperature
+        samples. Returns False when the server is unavailable or backing off.
+        """
+        now = time.monotonic()
+        if now < self.retry_at:
+            return False
+
+        try:
+            if self.host_info_pending:
+                publish_host_info(host_info)
+                self.host_info_pending = False
+
+            if temp_list:
+                publish_temps(host_info["host"], temp_list)
+        except (redis.ConnectionError, redis.TimeoutError) as err:
+            self.connected = False
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF) if self.backoff else 1
+            self.retry_at = now + self.backoff
+            self.host_info_pending = True
+            logger.warning(
+                "Redis server unavailable, retrying in %ss: %s", self.backoff, err
+            )
+            return False
+
+        if not self.connected:
+            logger.info("Connected to Redis server.")
+            self.connected = True
+            self.backoff = 0
+
+        return True
+
+
+def collect_host_info(pool, max_workers):
+    """Runs every collector, overlapping them on the pool, and returns the
+    inventory map for the host.
+    """
+    host_info = {}
+    host_info["host"] = platform.node()
+    host_info["kernel"] = platform.release()
+
+    # Collectors keyed by the host_info field they fill, a key of None merges
+    # the returned map into host_info
+    collectors = [
+        (get_cpu_info, "cpus", "CPU"),
+        (get_mem_info, None, "memory"),
+        (get_model_info, None, "platform"),
+    ]
+
+    futures = {}
+    for collector, key, label in collectors:
+        logger.info("Gathering %s info.", label)
+        futures[pool.submit(collector)] = (key, label)
+
+    # Disk collection runs on this thread while the other collectors run on
+    # the pool
+    logger.info("Gathering disk info.")
+    host_info["disks"] = get_disk_info(max_workers)
+    logger.info("Gathered disk info.")
+
+    for future in concurrent.futures.as_completed(futures):
+        key, label = futures[future]
+
+        if key is None:
+            host_info.update(future.result())
+        else:
+            host_info[key] = future.result()
+
+        logger.info("Gathered %s info.", label)
+
+    return host_info
+
+
+def load_cached_info():
+    """Returns the inventory saved by a previous run, or None when there is no
+    cache or it was written for a different kernel, machine or set of block
+    devices.
     """
     try:
-        host_info = {}
-        host_info["host"] = platform.node()
+        with open(CACHE_PATH, "rb") as cache_file:
+            cached = orjson.loads(cache_file.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return None
+
+    host_info = cached.get("host_info", {})
+
+    if (
+        host_info.get("host") != platform.node()
+        or host_info.get("kernel") != platform.release()
+        or host_info.get("serial")
+        != read_sys_file("/sys/class/dmi/id/product_serial")
+        or cached.get("devices") != get_block_devices()
+    ):
+        return None
+
+    return host_info
+
+
+def save_cached_info(host_info):
+    """Writes the inventory, along with the block devices it was collected
+    from, to the cache file. The file is replaced atomically so a reader never
+    sees a partial file.
+    """
+    tmp_path = f"{CACHE_PATH}.tmp"
+    cached = {"host_info": host_info, "devices": get_block_devices()}
+
+    try:
+        with open(tmp_path, "wb") as cache_file:
+            cache_file.write(orjson.dumps(cached))
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError as err:
+        logger.warning("Unable to write inventory cache: %s", err)
+
+
+def remove_cached_info():
+    """Deletes the cache file so the next start collects from scratch."""
+    try:
+        os.remove(CACHE_PATH)
+    except FileNotFoundError:
+        pass
+
 
-        logger.info("Connecting to Redis server...")
-        redis_conn = redis.Redis(host="192.168.10.6", port=6379, db=0)
-        redis_conn.setnx(f"{host_info['host']}", "connected")
-        logger.info("Connected to Redis server.")
+def next_deadline(deadline):
+    """Returns the deadline for the next sample, one POLL_INTERVAL after the
+    last. When that deadline has already passed the lag is logged and the
+    deadline skips ahead to the next aligned tick instead of bursting.
+    """
+    deadline += POLL_INTERVAL
+    lag = time.monotonic() - deadline
+
+    if lag > 0:
+        logger.warning("Sample lagged by %.2fs.", lag)
+        deadline += math.ceil(lag / POLL_INTERVAL) * POLL_INTERVAL
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            cpus_future = executor.submit(get_cpu_info)
-            mem_future = executor.submit(get_mem_info)
-            model_future = executor.submit(get_model_info)
-            disks_future = executor.submit(get_disk_info)
+    return deadline
 
-        logger.info("Gathering disk info.")
-        host_info["disks"] = disks_future.result()
 
-        logger.info("Gathering CPU info.")
-        host_info["cpus"] = cpus_future.result()
+def apply_refresh(fresh_info, host_info, temp_sources, temp_shm, publisher):
+    """Compares the inventory from the background refresh with the cached one.
+    When they differ the cache is rewritten, the inventory is republished and
+    the temperature sources are reopened for the new disks. Returns the
+    inventory and temperature sources to keep polling with.
+    """
+    if fresh_info == host_info:
+        return host_info, temp_sources
+
+    logger.warning("Cached inventory was stale, replacing.")
+    save_cached_info(fresh_info)
+    publisher.republish_host_info()
 
-        logger.info("Gathering memory info.")
-        host_info.update(mem_future.result())
+    close_temp_sources(temp_sources)
+    temp_sources = get_temp_sources(fresh_info["disks"])
 
-        logger.info("Gathering platform info.")
-        host_info.update(model_future.result())
+    if temp_shm is not None:
+        temp_shm.layout(name for name, _, _ in temp_sources)
 
-        logger.info(host_info)
+    return fresh_info, temp_sources
 
-        while True:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                temp_futures = executor.map(get_disk_temps, host_info["disks"])
-                temp_list = list(temp_futures)
-                print("|".join(temp_list))
-                time.sleep(5)
+
+def main():
+    """Connects to the Redis server, publishes the information collected from
+    the node and then keeps publishing disk temperatures.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=8,
+        help="threads in the shared pool and concurrent smartctl runs",
+    )
+    parser.add_argument(
+        "--shm",
+        action="store_true",
+        help=f"also write temperatures to the {SHM_NAME} shared memory segment",
+    )
+    args = parser.parse_args()
+
+    # A warm start refreshes the inventory on the pool while polling also
+    # uses it, one worker would leave the refresh waiting on itself
+    if args.max_workers < 2:
+        parser.error("--max-workers must be at least 2")
+
+    warm_start = False
+
+    try:
+        publisher = RedisPublisher()
+
+        # One pool is shared by startup collection and polling for the life of
+        # the daemon, smartctl runs are fanned out as child processes by
+        # run_commands
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.max_workers
+        ) as executor:
+            refresh_future = None
+            host_info = load_cached_info()
+
+            if host_info is None:
+                host_info = collect_host_info(executor, args.max_workers)
+                save_cached_info(host_info)
+            else:
+                # Publish the cached inventory straight away and validate it
+                # in the background
+                logger.info("Loaded inventory from %s.", CACHE_PATH)
+                warm_start = True
+                refresh_future = executor.submit(
+                    collect_host_info, executor, args.max_workers
+                )
+
+            logger.info(orjson.dumps(host_info).decode())
+
+            logger.info("Connecting to Redis server...")
+            publisher.publish(host_info)
+
+            temp_sources = get_temp_sources(host_info["disks"])
+
+            temp_shm = None
+            if args.shm:
+                temp_shm = TempSharedMemory()
+                temp_shm.layout(name for name, _, _ in temp_sources)
+
+            # Samples are scheduled against a monotonic deadline so the time
+            # spent collecting does not stretch the polling period
+            deadline = time.monotonic()
+
+            try:
+                while True:
+                    if refresh_future is not None and refresh_future.done():
+                        host_info, temp_sources = apply_refresh(
+                            refresh_future.result(),
+                            host_info,
+                            temp_sources,
+                            temp_shm,
+                            publisher,
+                        )
+                        refresh_future = None
+
+                    temp_list = get_disk_temps(
+                        temp_sources, executor, args.max_workers
+                    )
+                    write_temps(temp_list)
+
+                    if temp_shm is not None:
+                        temp_shm.write(temp_list)
+
+                    publisher.publish(host_info, temp_list)
+
+                    deadline = next_deadline(deadline)
+                    time.sleep(max(0, deadline - time.monotonic()))
+            finally:
+                close_temp_sources(temp_sources)
+
+                if temp_shm is not None:
+                    temp_shm.close()
 
     except Exception as err:
         logger.error(err)
 
+        # The cache may be what broke this run, drop it so a restart does not
+        # fail the same way until the next reboot
+        if warm_start:
+            remove_cached_info()
+
     return 0
 
 